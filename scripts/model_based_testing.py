@@ -9,18 +9,23 @@ for ALL transitions in the state machine.
 Usage:
     python model_based_testing.py --spec BookingMethods --output tests/generated_mbt.rs
     python model_based_testing.py --spec Inventory --depth 3 --output tests/inventory_mbt.rs
+    python model_based_testing.py --spec BookingMethods,Inventory --output tests/
 """
 
+import io
+import os
 import re
+import shutil
 import sys
 import argparse
 from dataclasses import dataclass
+from multiprocessing import Pool
 from pathlib import Path
-from typing import Any, Iterator
+from typing import Any, Iterator, TextIO
 from itertools import product
 
 
-@dataclass
+@dataclass(slots=True)
 class StateVariable:
     """Represents a TLA+ state variable."""
     name: str
@@ -29,7 +34,7 @@ class StateVariable:
     initial_value: Any
 
 
-@dataclass
+@dataclass(slots=True)
 class Action:
     """Represents a TLA+ action (state transition)."""
     name: str
@@ -39,13 +44,16 @@ class Action:
     rust_implementation: str
 
 
-@dataclass
+@dataclass(slots=True)
 class StateModel:
     """Complete TLA+ state machine model."""
     name: str
     variables: list[StateVariable]
     actions: list[Action]
     invariants: list[str]
+    # State variable passed to check_invariants at the end of each test;
+    # None when the model has no Rust value to check the invariants on
+    checked_variable: str | None = None
 
 
 # Predefined models based on TLA+ specs
@@ -67,7 +75,7 @@ BOOKING_MODEL = StateModel(
             precondition="lots.len() < MAX_LOTS",
             effect="lots.push(Lot { units, cost, date })",
             rust_implementation="""
-    let lot = Lot { units: {units}, cost_per_unit: dec!({cost}), date: make_date({date}) };
+    let lot = Lot {{ units: {units}, cost_per_unit: dec!({cost}), date: make_date({date}) }};
     inventory.add_position(lot.into());
 """,
         ),
@@ -164,6 +172,7 @@ INVENTORY_MODEL = StateModel(
         "NonNegativeUnits: units never negative (except NONE)",
         "ValidPositions: no zero-unit positions",
     ],
+    checked_variable="inventory",
 )
 
 MODELS = {
@@ -172,48 +181,118 @@ MODELS = {
 }
 
 
-def generate_test_sequences(model: StateModel, depth: int) -> Iterator[list[tuple[Action, dict]]]:
-    """Generate all possible action sequences up to given depth."""
-    def generate_params(action: Action) -> Iterator[dict]:
-        """Generate parameter combinations for an action."""
-        param_values = []
-        for name, tla_type, rust_type in action.parameters:
-            if "1.." in tla_type:
-                # Range type - sample a few values
-                match = re.match(r"(\d+)\.\.(\w+)", tla_type)
-                if match:
-                    start = int(match.group(1))
-                    param_values.append([(name, v) for v in [start, start + 1, start + 2]])
-                else:
-                    param_values.append([(name, 1)])
-            elif tla_type == "BookingMethod":
-                param_values.append([(name, m) for m in ["FIFO", "LIFO", "HIFO"]])
-            elif tla_type == "Currencies":
-                param_values.append([(name, c) for c in ["USD", "AAPL"]])
-            else:
-                param_values.append([(name, "default")])
+_RANGE_RE = re.compile(r"(\d+)\.\.(\w+)")
 
-        for combo in product(*param_values):
-            yield dict(combo)
+# Parameter combinations per action, keyed by id(action). The action is
+# stored alongside so a recycled id from a collected action is not reused.
+_PARAM_CACHE: dict[int, tuple[Action, list[dict]]] = {}
 
-    def generate_sequences(current_depth: int) -> Iterator[list[tuple[Action, dict]]]:
-        """Recursively generate action sequences."""
-        if current_depth == 0:
-            yield []
-            return
 
-        for shorter in generate_sequences(current_depth - 1):
-            yield shorter  # Include shorter sequences too
+def generate_params(action: Action) -> list[dict]:
+    """Generate parameter combinations for an action.
 
-            for action in model.actions:
-                for params in generate_params(action):
-                    yield shorter + [(action, params)]
+    Combinations are a pure function of the action definition, so they are
+    computed on first use and cached for the lifetime of the process.
+    """
+    key = id(action)
+    cached = _PARAM_CACHE.get(key)
+    if cached is not None and cached[0] is action:
+        return cached[1]
 
-    yield from generate_sequences(depth)
+    param_values = []
+    for name, tla_type, rust_type in action.parameters:
+        if "1.." in tla_type:
+            # Range type - sample a few values
+            match = _RANGE_RE.match(tla_type)
+            if match:
+                start = int(match.group(1))
+                param_values.append([(name, v) for v in [start, start + 1, start + 2]])
+            else:
+                param_values.append([(name, 1)])
+        elif tla_type == "BookingMethod":
+            param_values.append([(name, m) for m in ["FIFO", "LIFO", "HIFO"]])
+        elif tla_type == "Currencies":
+            param_values.append([(name, c) for c in ["USD", "AAPL"]])
+        else:
+            param_values.append([(name, "default")])
+
+    combos = [dict(combo) for combo in product(*param_values)]
+    _PARAM_CACHE[key] = (action, combos)
+    return combos
+
+
+def generate_test_sequences(
+    model: StateModel, depth: int, max_sequences: int | None = None
+) -> Iterator[list[tuple[Action, dict]]]:
+    """Generate all possible action sequences up to given depth.
+
+    Sequences are produced breadth-first: every sequence of length k is
+    yielded before any sequence of length k + 1, and each length is built by
+    extending only the previous frontier. Generation stops once
+    ``max_sequences`` sequences have been yielded.
+    """
+    if max_sequences is not None and max_sequences <= 0:
+        return
+
+    steps = [(action, generate_params(action)) for action in model.actions]
+
+    yielded = 0
+    frontier: list[list[tuple[Action, dict]]] = [[]]
+    for level in range(depth):
+        last_level = level == depth - 1
+        next_frontier = []
+        for seq in frontier:
+            for action, param_combos in steps:
+                for params in param_combos:
+                    new_seq = seq + [(action, params)]
+                    yield new_seq
+                    yielded += 1
+                    if max_sequences is not None and yielded >= max_sequences:
+                        return
+                    if not last_level:
+                        next_frontier.append(new_seq)
+        frontier = next_frontier
+
+
+class _TemplateParams(dict):
+    """Parameter mapping for rust_implementation templates.
+
+    Placeholders without a matching parameter are left in the output as-is.
+    """
+
+    def __missing__(self, key: str) -> str:
+        return "{" + key + "}"
+
+
+# Rendered step blocks, keyed by (id(action), parameter items); the action
+# is stored with each block so a recycled id is not mistaken for it
+_STEP_CACHE: dict[tuple, tuple[Action, str]] = {}
+
+
+def render_step(action: Action, params: dict) -> str:
+    """Render the Rust code for one action step.
+
+    The same (action, params) pair appears in many sequences, so each block
+    is rendered once and reused.
+    """
+    key = (id(action), tuple(params.items()))
+    cached = _STEP_CACHE.get(key)
+    if cached is not None and cached[0] is action:
+        return cached[1]
+
+    impl = action.rust_implementation.format_map(_TemplateParams(params))
+    step = (
+        f"    // Action: {action.name}({', '.join(f'{k}={v}' for k, v in params.items())})\n"
+        f"{impl.strip()}\n"
+    )
+    _STEP_CACHE[key] = (action, step)
+    return step
 
 
-def generate_rust_test(model: StateModel, sequence: list[tuple[Action, dict]], test_num: int) -> str:
-    """Generate a Rust test from an action sequence."""
+def write_rust_test(
+    out: TextIO, model: StateModel, sequence: list[tuple[Action, dict]], test_num: int
+) -> None:
+    """Write a Rust test for an action sequence to ``out``."""
     # Create test name from actions
     action_names = "_".join(a.name.lower() for a, _ in sequence[:3])
     if len(sequence) > 3:
@@ -221,50 +300,63 @@ def generate_rust_test(model: StateModel, sequence: list[tuple[Action, dict]], t
 
     test_name = f"mbt_{model.name.lower()}_{action_names}_{test_num}"
 
+    out.write(f"\n/// MBT Generated Test #{test_num}\n")
+    out.write(f"/// Sequence: {' -> '.join(a.name for a, _ in sequence)}\n")
+    out.write(f"#[test]\nfn {test_name}() {{\n")
+
     # Generate test body
-    setup = "\n".join(f"    let mut {v.name} = {v.initial_value};" for v in model.variables)
+    for v in model.variables:
+        out.write(f"    let mut {v.name} = {v.initial_value};\n")
+    out.write("\n")
 
-    steps = []
     for action, params in sequence:
-        impl = action.rust_implementation
-        for param_name, param_value in params.items():
-            impl = impl.replace(f"{{{param_name}}}", str(param_value))
-        steps.append(f"    // Action: {action.name}({', '.join(f'{k}={v}' for k, v in params.items())})")
-        steps.append(impl.strip())
-
-    # Generate invariant checks
-    invariant_checks = "\n".join(f"    // Check: {inv}" for inv in model.invariants)
-
-    return f"""
-/// MBT Generated Test #{test_num}
-/// Sequence: {' -> '.join(a.name for a, _ in sequence)}
-#[test]
-fn {test_name}() {{
-{setup}
-
-{chr(10).join(steps)}
-
-{invariant_checks}
-    // Invariants checked by construction
-}}
-"""
+        out.write(render_step(action, params))
+    out.write("\n")
+
+    # Invariants are defined once in the module header
+    if model.checked_variable is not None:
+        out.write(f"    check_invariants(&{model.checked_variable});\n")
+    out.write("}\n")
+
+
+def _invariants_block(model: StateModel) -> str:
+    """Return the module-header Rust code listing the model's invariants."""
+    if model.checked_variable is None:
+        checks = "".join(f"// Check: {inv}\n" for inv in model.invariants)
+        return (
+            f"// Invariants of the {model.name} model\n"
+            f"{checks}"
+            "// Invariants checked by construction\n"
+        )
+    checks = "".join(f"    // Check: {inv}\n" for inv in model.invariants)
+    var = next(v for v in model.variables if v.name == model.checked_variable)
+    return (
+        f"/// Invariants of the {model.name} model, checked at the end of every test.\n"
+        f"fn check_invariants({var.name}: &{var.rust_type}) {{\n"
+        f"{checks}"
+        "    // Invariants checked by construction\n"
+        "}\n"
+    )
 
 
-def generate_test_module(model: StateModel, depth: int, max_tests: int) -> str:
-    """Generate a complete Rust test module."""
-    tests = []
-    test_num = 0
+def generate_test_module(
+    model: StateModel, depth: int, max_tests: int, out: TextIO
+) -> int:
+    """Write a complete Rust test module to ``out``.
 
-    for sequence in generate_test_sequences(model, depth):
-        if not sequence:
-            continue  # Skip empty sequences
+    The header reports the test count, so the tests are buffered until all
+    of them have been rendered and then copied to ``out`` after the header.
 
-        test = generate_rust_test(model, sequence, test_num)
-        tests.append(test)
-        test_num += 1
+    Returns the number of tests written.
+    """
+    body = io.StringIO()
+    test_num = 0
 
-        if test_num >= max_tests:
-            break
+    for sequence in generate_test_sequences(model, depth, max_tests):
+        if test_num:
+            body.write("\n")
+        write_rust_test(body, model, sequence, test_num)
+        test_num += 1
 
     imports = """//! Model-Based Tests Generated from TLA+ Specification
 //!
@@ -307,9 +399,41 @@ impl From<Lot> for Position {{
         }}
     }}
 }}
-""".format(name=model.name, depth=depth, count=len(tests))
 
-    return imports + "\n".join(tests)
+{invariants}""".format(
+        name=model.name,
+        depth=depth,
+        count=test_num,
+        invariants=_invariants_block(model),
+    )
+
+    out.write(imports)
+    body.seek(0)
+    shutil.copyfileobj(body, out)
+    return test_num
+
+
+def parse_spec_list(value: str) -> list[str]:
+    """Parse a comma-separated list of model names for --spec.
+
+    Repeated names are kept once, in order of first appearance.
+    """
+    specs = list(dict.fromkeys(spec.strip() for spec in value.split(",") if spec.strip()))
+    unknown = [spec for spec in specs if spec not in MODELS]
+    if not specs or unknown:
+        raise argparse.ArgumentTypeError(
+            f"invalid spec {', '.join(unknown) or repr(value)} "
+            f"(choose from {', '.join(MODELS)})"
+        )
+    return specs
+
+
+def _generate_one(job: tuple[str, int, int]) -> tuple[str, str]:
+    """Generate the test module for one spec (multiprocessing worker)."""
+    spec, depth, max_tests = job
+    out = io.StringIO()
+    generate_test_module(MODELS[spec], depth, max_tests, out)
+    return spec, out.getvalue()
 
 
 def main():
@@ -318,9 +442,10 @@ def main():
     )
     parser.add_argument(
         "--spec", "-s",
-        choices=list(MODELS.keys()),
+        type=parse_spec_list,
         required=True,
-        help="TLA+ specification to generate tests from"
+        help="TLA+ specification to generate tests from, or a comma-separated "
+             f"list of them (choices: {', '.join(MODELS)})"
     )
     parser.add_argument(
         "--depth", "-d",
@@ -337,19 +462,44 @@ def main():
     parser.add_argument(
         "--output", "-o",
         type=Path,
-        help="Output Rust file (default: stdout)"
+        help="Output Rust file (default: stdout); with several specs, the "
+             "directory to write <spec>_mbt.rs files into"
     )
 
     args = parser.parse_args()
 
-    model = MODELS[args.spec]
-    rust_code = generate_test_module(model, args.depth, args.max_tests)
+    if len(args.spec) > 1:
+        if not args.output:
+            parser.error("--output directory is required with several specs")
+
+        # Each model is independent, so generate them in parallel processes
+        args.output.mkdir(parents=True, exist_ok=True)
+        jobs = [(spec, args.depth, args.max_tests) for spec in args.spec]
+        with Pool(min(len(jobs), os.cpu_count() or 1)) as pool:
+            results = pool.map(_generate_one, jobs)
+
+        for spec, rust_code in results:
+            path = args.output / f"{spec.lower()}_mbt.rs"
+            path.write_text(rust_code)
+            print(f"Generated {path}", file=sys.stderr)
+        return
+
+    model = MODELS[args.spec[0]]
 
     if args.output:
-        args.output.write_text(rust_code)
+        # Write into a sibling temporary file and move it into place once the
+        # module is complete, so a failed run leaves the target as it was
+        tmp_path = args.output.with_name(f".{args.output.name}.tmp")
+        try:
+            with open(tmp_path, "w") as out:
+                generate_test_module(model, args.depth, args.max_tests, out)
+            os.replace(tmp_path, args.output)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
         print(f"Generated {args.output}", file=sys.stderr)
     else:
-        print(rust_code)
+        generate_test_module(model, args.depth, args.max_tests, sys.stdout)
 
 
 if __name__ == "__main__":
@@ -14,11 +14,35 @@ import json
 import re
 import sys
 import argparse
-from dataclasses import dataclass
-from typing import Any
+from dataclasses import dataclass, fields
+from typing import Any, Iterable, Iterator, TextIO
 
+try:
+    import orjson
+except ImportError:  # Optional: fall back to the stdlib encoder
+    orjson = None
 
-@dataclass
+
+_INT_RE = re.compile(r'^-?\d+$')
+_INV_RE = re.compile(r'Invariant (\w+) is violated')
+_PROP_RE = re.compile(r'Property (\w+) is violated')
+_STATE_RE = re.compile(r'^State (\d+):')
+_ACTION_RE = re.compile(r'<(\w+)')
+_VAR_RE = re.compile(r'^/\\ (\w+) = (.+)$')
+
+# Lines TLC prints after the counterexample trace
+_END_MARKERS = ("Progress(", "Finished", "The number of states")
+
+_OPEN = frozenset('{[(<')
+_CLOSE = frozenset('}])>')
+_STRUCTURAL_RE = re.compile(r'["{}\[\]()<>,]')
+
+# First characters of values that _parse_atom leaves to parse_tla_value
+_STRUCTURED = frozenset('{<[(')
+_NOT_ATOM = object()
+
+
+@dataclass(slots=True)
 class TLAValue:
     """Represents a TLA+ value that can be converted to Rust."""
     tla_type: str
@@ -28,7 +52,7 @@ class TLAValue:
         return {"type": self.tla_type, "value": self.value}
 
 
-@dataclass
+@dataclass(slots=True)
 class TraceState:
     """A single state in a TLA+ counterexample trace."""
     state_num: int
@@ -36,7 +60,7 @@ class TraceState:
     variables: dict[str, Any]
 
 
-@dataclass
+@dataclass(slots=True)
 class Trace:
     """A complete TLA+ counterexample trace."""
     spec_name: str
@@ -60,114 +84,221 @@ class Trace:
         }
 
 
-def parse_tla_value(value_str: str) -> Any:
-    """Parse a TLA+ value string into a Python value."""
-    value_str = value_str.strip()
+def _json_default(obj: Any) -> Any:
+    """Serialize trace dataclasses for json.dump without building to_dict() copies."""
+    if isinstance(obj, TLAValue):
+        return obj.to_dict()
+    if isinstance(obj, (Trace, TraceState)):
+        return {f.name: getattr(obj, f.name) for f in fields(obj)}
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def write_trace_json(trace: Trace, out: TextIO) -> None:
+    """Write a trace to ``out`` as indented JSON.
+
+    Uses orjson when it is installed and the stdlib encoder otherwise.
+    """
+    if orjson is not None:
+        data = orjson.dumps(
+            trace,
+            default=_json_default,
+            option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATACLASS,
+        )
+        out.write(data.decode())
+    else:
+        json.dump(trace, out, indent=2, default=_json_default)
+    out.write('\n')
+
+
+def parse_tla_value(value_str: str, *, stripped: bool = False) -> Any:
+    """Parse a TLA+ value string into a Python value.
+
+    Pass ``stripped=True`` when the caller has already removed surrounding
+    whitespace.
+    """
+    if not stripped:
+        value_str = value_str.strip()
+    if not value_str:
+        return value_str
+
+    # Structured values, strings, booleans and null are identified by their
+    # first character
+    handler = _DISPATCH.get(value_str[0])
+    if handler is not None:
+        return handler(value_str)
+
+    # Number (integer)
+    if _INT_RE.match(value_str):
+        return int(value_str)
+
+    # Default: return as string
+    return value_str
+
+
+def _parse_atom(value_str: str) -> Any:
+    """Parse an already-stripped scalar TLA+ value without recursing.
 
-    # Boolean
+    Returns ``_NOT_ATOM`` for sets, sequences, records and functions, which
+    need the full parse_tla_value.
+    """
+    if _INT_RE.match(value_str):
+        return int(value_str)
+    c = value_str[:1]
+    if c in _STRUCTURED:
+        return _NOT_ATOM
+    handler = _DISPATCH.get(c)
+    if handler is not None:
+        return handler(value_str)
+    return value_str
+
+
+def _parse_bool(value_str: str) -> Any:
+    """Parse TRUE/FALSE."""
     if value_str == "TRUE":
         return True
     if value_str == "FALSE":
         return False
+    return value_str
 
-    # Number (integer)
-    if re.match(r'^-?\d+$', value_str):
-        return int(value_str)
-
-    # String
-    if value_str.startswith('"') and value_str.endswith('"'):
-        return value_str[1:-1]
 
-    # Set: {a, b, c}
-    if value_str.startswith('{') and value_str.endswith('}'):
-        inner = value_str[1:-1].strip()
-        if not inner:
-            return {"type": "set", "elements": []}
-        # Handle nested structures by tracking depth
-        elements = split_tla_list(inner)
-        return {"type": "set", "elements": [parse_tla_value(e) for e in elements]}
-
-    # Sequence: <<a, b, c>>
-    if value_str.startswith('<<') and value_str.endswith('>>'):
-        inner = value_str[2:-2].strip()
-        if not inner:
-            return {"type": "sequence", "elements": []}
-        elements = split_tla_list(inner)
-        return {"type": "sequence", "elements": [parse_tla_value(e) for e in elements]}
-
-    # Record: [field1 |-> val1, field2 |-> val2]
-    if value_str.startswith('[') and value_str.endswith(']'):
-        inner = value_str[1:-1].strip()
-        if not inner:
-            return {"type": "record", "fields": {}}
-
-        fields = {}
-        # Parse field |-> value pairs
-        parts = split_tla_list(inner)
-        for part in parts:
-            if ' |-> ' in part:
-                field, val = part.split(' |-> ', 1)
-                fields[field.strip()] = parse_tla_value(val.strip())
-
-        return {"type": "record", "fields": fields}
-
-    # Function: (arg1 :> val1 @@ arg2 :> val2)
-    if value_str.startswith('(') and value_str.endswith(')') and ':>' in value_str:
-        inner = value_str[1:-1].strip()
-        mapping = {}
-        parts = inner.split('@@')
-        for part in parts:
-            part = part.strip()
-            if ':>' in part:
-                key, val = part.split(':>', 1)
-                mapping[parse_tla_value(key.strip())] = parse_tla_value(val.strip())
-        return {"type": "function", "mapping": mapping}
-
-    # Null/None
+def _parse_null(value_str: str) -> Any:
+    """Parse NULL/null."""
     if value_str == "NULL" or value_str == "null":
         return None
+    return value_str
 
-    # Default: return as string
+
+def _parse_string(value_str: str) -> Any:
+    """Parse a quoted string: "abc"."""
+    if value_str.endswith('"'):
+        return value_str[1:-1]
     return value_str
 
 
-def split_tla_list(s: str) -> list[str]:
-    """Split a TLA+ comma-separated list, respecting nested structures."""
-    elements = []
-    current = []
+def _parse_set(value_str: str) -> Any:
+    """Parse a set: {a, b, c}."""
+    if not value_str.endswith('}'):
+        return value_str
+    inner = value_str[1:-1].strip()
+    if not inner:
+        return {"type": "set", "elements": []}
+    # Handle nested structures by tracking depth
+    elements = split_tla_list(inner)
+    return {"type": "set", "elements": [parse_tla_value(e, stripped=True) for e in elements]}
+
+
+def _parse_sequence(value_str: str) -> Any:
+    """Parse a sequence: <<a, b, c>>."""
+    if not (value_str.startswith('<<') and value_str.endswith('>>')):
+        return value_str
+    inner = value_str[2:-2].strip()
+    if not inner:
+        return {"type": "sequence", "elements": []}
+    elements = split_tla_list(inner)
+    return {"type": "sequence", "elements": [parse_tla_value(e, stripped=True) for e in elements]}
+
+
+def _parse_record(value_str: str) -> Any:
+    """Parse a record: [field1 |-> val1, field2 |-> val2]."""
+    if not value_str.endswith(']'):
+        return value_str
+    inner = value_str[1:-1].strip()
+    if not inner:
+        return {"type": "record", "fields": {}}
+
+    fields = {}
+    # Parse field |-> value pairs
+    parts = split_tla_list(inner)
+    for part in parts:
+        if ' |-> ' in part:
+            field, val = part.split(' |-> ', 1)
+            val = val.strip()
+            parsed = _parse_atom(val)
+            if parsed is _NOT_ATOM:
+                parsed = parse_tla_value(val, stripped=True)
+            fields[field.strip()] = parsed
+
+    return {"type": "record", "fields": fields}
+
+
+def _parse_function(value_str: str) -> Any:
+    """Parse a function: (arg1 :> val1 @@ arg2 :> val2)."""
+    if not (value_str.endswith(')') and ':>' in value_str):
+        return value_str
+    inner = value_str[1:-1].strip()
+    mapping = {}
+    parts = inner.split('@@')
+    for part in parts:
+        part = part.strip()
+        if ':>' in part:
+            key, val = part.split(':>', 1)
+            key = key.strip()
+            parsed_key = _parse_atom(key)
+            if parsed_key is _NOT_ATOM:
+                parsed_key = parse_tla_value(key, stripped=True)
+            mapping[parsed_key] = parse_tla_value(val.strip(), stripped=True)
+    return {"type": "function", "mapping": mapping}
+
+
+_DISPATCH = {
+    '{': _parse_set,
+    '<': _parse_sequence,
+    '[': _parse_record,
+    '(': _parse_function,
+    '"': _parse_string,
+    'T': _parse_bool,
+    'F': _parse_bool,
+    'N': _parse_null,
+    'n': _parse_null,
+}
+
+
+def split_tla_list(s: str) -> Iterator[str]:
+    """Split a TLA+ comma-separated list, respecting nested structures.
+
+    Only quotes, brackets and commas affect the split, so the scan jumps
+    between those characters with a compiled regex instead of visiting every
+    character in Python. Elements are yielded as they are found.
+    """
+    start = 0
     depth = 0
     in_string = False
 
-    i = 0
-    while i < len(s):
+    for match in _STRUCTURAL_RE.finditer(s):
+        i = match.start()
         c = s[i]
 
         if c == '"' and (i == 0 or s[i-1] != '\\'):
             in_string = not in_string
-            current.append(c)
         elif in_string:
-            current.append(c)
-        elif c in '{[(<':
+            pass
+        elif c in _OPEN:
             depth += 1
-            current.append(c)
-        elif c in '}])>':
+        elif c in _CLOSE:
             depth -= 1
-            current.append(c)
         elif c == ',' and depth == 0:
-            elements.append(''.join(current).strip())
-            current = []
-        else:
-            current.append(c)
-        i += 1
+            element = s[start:i].strip()
+            if element:
+                yield element
+            start = i + 1
 
-    if current:
-        elements.append(''.join(current).strip())
+    tail = s[start:].strip()
+    if tail:
+        yield tail
 
-    return [e for e in elements if e]
 
+def parse_tlc_output(
+    lines: Iterable[str], spec_name: str = "Unknown", max_states: int | None = None
+) -> Trace | None:
+    """Parse TLC model checker output and extract counterexample trace.
 
-def parse_tlc_output(lines: list[str], spec_name: str = "Unknown") -> Trace | None:
-    """Parse TLC model checker output and extract counterexample trace."""
+    ``lines`` is consumed in a single pass, so an open file can be passed
+    directly without reading it into memory first. Identical variable values
+    are parsed once and the resulting objects are shared between states.
+
+    Parsing stops at the first TLC progress/statistics line after the trace,
+    or once ``max_states`` states have been collected.
+    """
     states = []
     invariant_violated = None
     property_violated = None
@@ -175,19 +306,22 @@ def parse_tlc_output(lines: list[str], spec_name: str = "Unknown") -> Trace | No
     current_action = None
     current_vars = {}
     in_trace = False
+    # Unchanged variables repeat the same value text across states, so each
+    # distinct value is parsed once and shared between states
+    value_cache: dict[str, Any] = {}
 
     for line in lines:
-        line = line.rstrip()
+        line = line.rstrip('\n')
 
         # Check for invariant violation
         if "Invariant" in line and "is violated" in line:
-            match = re.search(r'Invariant (\w+) is violated', line)
+            match = _INV_RE.search(line)
             if match:
                 invariant_violated = match.group(1)
 
         # Check for property violation
         if "Property" in line and "is violated" in line:
-            match = re.search(r'Property (\w+) is violated', line)
+            match = _PROP_RE.search(line)
             if match:
                 property_violated = match.group(1)
 
@@ -196,8 +330,12 @@ def parse_tlc_output(lines: list[str], spec_name: str = "Unknown") -> Trace | No
             in_trace = True
             continue
 
+        # End of trace: TLC statistics follow the last state
+        if current_state_num is not None and line.startswith(_END_MARKERS):
+            break
+
         # State line: "State 1: <Init line 50, col 1 to line 55, col 20 of module Foo>"
-        state_match = re.match(r'^State (\d+):', line)
+        state_match = _STATE_RE.match(line)
         if state_match:
             # Save previous state if exists
             if current_state_num is not None:
@@ -207,9 +345,13 @@ def parse_tlc_output(lines: list[str], spec_name: str = "Unknown") -> Trace | No
                     variables=current_vars
                 ))
 
+            if max_states is not None and len(states) >= max_states:
+                current_state_num = None
+                break
+
             current_state_num = int(state_match.group(1))
             # Try to extract action name
-            action_match = re.search(r'<(\w+)', line)
+            action_match = _ACTION_RE.search(line)
             current_action = action_match.group(1) if action_match else None
             current_vars = {}
             in_trace = True
@@ -217,11 +359,16 @@ def parse_tlc_output(lines: list[str], spec_name: str = "Unknown") -> Trace | No
 
         # Variable assignment: "/\ varname = value"
         if in_trace and line.startswith('/\\'):
-            var_match = re.match(r'^/\\ (\w+) = (.+)$', line)
+            var_match = _VAR_RE.match(line)
             if var_match:
                 var_name = var_match.group(1)
                 var_value = var_match.group(2)
-                current_vars[var_name] = parse_tla_value(var_value)
+                if var_value in value_cache:
+                    parsed = value_cache[var_value]
+                else:
+                    parsed = parse_tla_value(var_value)
+                    value_cache[var_value] = parsed
+                current_vars[var_name] = parsed
 
         # Continuation of multi-line value
         elif in_trace and current_vars and not line.startswith('State'):
@@ -247,6 +394,17 @@ def parse_tlc_output(lines: list[str], spec_name: str = "Unknown") -> Trace | No
     )
 
 
+def positive_int(value: str) -> int:
+    """Parse a positive integer command-line argument."""
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be a positive integer, got {value!r}")
+    return number
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Convert TLC counterexample traces to JSON"
@@ -269,15 +427,19 @@ def main():
         default=sys.stdout,
         help="Output JSON file (default: stdout)"
     )
+    parser.add_argument(
+        "--max-states",
+        type=positive_int,
+        default=None,
+        help="Maximum number of trace states to keep (default: all)"
+    )
 
     args = parser.parse_args()
 
-    lines = args.input.readlines()
-    trace = parse_tlc_output(lines, args.spec)
+    trace = parse_tlc_output(args.input, args.spec, args.max_states)
 
     if trace:
-        json.dump(trace.to_dict(), args.output, indent=2)
-        args.output.write('\n')
+        write_trace_json(trace, args.output)
     else:
         print("No counterexample trace found in input", file=sys.stderr)
         sys.exit(1)
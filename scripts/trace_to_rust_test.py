@@ -9,11 +9,28 @@ Usage:
     python trace_to_rust_test.py --module booking traces/*.json > generated_tests.rs
 """
 
+import hashlib
+import io
 import json
+import os
+import re
 import sys
 import argparse
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Any
+from types import MappingProxyType
+from typing import Any, Iterator
+
+try:
+    import ijson
+except ImportError:  # Optional: fall back to loading whole files
+    ijson = None
+
+try:
+    import orjson
+except ImportError:  # Optional: fall back to the stdlib decoder
+    orjson = None
 
 
 # Maps TLA+ spec names to Rust module templates
@@ -102,83 +119,160 @@ fn make_date(days: i32) -> NaiveDate {
 }
 
 
+_SETUP_FN_RE = re.compile(r"^fn (\w+)", re.MULTILINE)
+# Shared read-only defaults for missing trace fields, so lookups in the
+# per-state and per-value loops don't allocate a fresh [] or {} each time
+_NO_ITEMS = ()
+_NO_FIELDS = MappingProxyType({})
+
+# Characters not allowed in generated test names
+_SANITIZE_RE = re.compile(r"[^0-9A-Za-z_]")
+
+
+def _split_setup(setup: str) -> dict[str, str]:
+    """Split a setup block into its helper functions, keyed by function name."""
+    starts = list(_SETUP_FN_RE.finditer(setup))
+    helpers = {}
+    for match, next_match in zip(starts, starts[1:] + [None]):
+        end = next_match.start() if next_match else len(setup)
+        helpers[match.group(1)] = setup[match.start():end].strip()
+    return helpers
+
+
+# Per-spec import lines and helper functions, parsed once so that modules
+# mixing several specs emit each `use` and each helper a single time
+_SPEC_IMPORTS = {
+    name: [line.strip() for line in template["imports"].strip().splitlines()]
+    for name, template in SPEC_TEMPLATES.items()
+}
+_SPEC_HELPERS = {
+    name: _split_setup(template["setup"])
+    for name, template in SPEC_TEMPLATES.items()
+}
+
+
 def tla_to_rust_value(value: Any, indent: int = 0) -> str:
     """Convert a TLA+ value (parsed as Python) to Rust code."""
-    ind = "    " * indent
-
-    if value is None:
-        return "None"
-
-    if isinstance(value, bool):
-        return "true" if value else "false"
-
-    if isinstance(value, int):
-        return str(value)
-
-    if isinstance(value, str):
-        return f'"{value}"'
-
-    if isinstance(value, dict):
-        if value.get("type") == "set":
-            elements = value.get("elements", [])
-            if not elements:
-                return "HashSet::new()"
-            els = ", ".join(tla_to_rust_value(e, indent) for e in elements)
-            return f"HashSet::from([{els}])"
-
-        if value.get("type") == "sequence":
-            elements = value.get("elements", [])
-            if not elements:
-                return "vec![]"
-            els = ", ".join(tla_to_rust_value(e, indent) for e in elements)
-            return f"vec![{els}]"
-
-        if value.get("type") == "record":
-            fields = value.get("fields", {})
-            if not fields:
-                return "/* empty record */"
-            # This is context-dependent - generate a struct literal comment
-            field_strs = []
-            for k, v in fields.items():
-                field_strs.append(f"{k}: {tla_to_rust_value(v, indent + 1)}")
-            return "{\n" + ind + "    " + (",\n" + ind + "    ").join(field_strs) + "\n" + ind + "}"
-
-        if value.get("type") == "function":
-            mapping = value.get("mapping", {})
-            if not mapping:
-                return "HashMap::new()"
-            entries = []
-            for k, v in mapping.items():
-                entries.append(f"({tla_to_rust_value(k)}, {tla_to_rust_value(v)})")
-            return f"HashMap::from([{', '.join(entries)}])"
+    handler = _SCALAR_HANDLERS.get(type(value))
+    if handler is not None:
+        return handler(value, indent)
+
+    if type(value) is dict:
+        return _DICT_HANDLERS.get(value.get("type"), _emit_unknown)(value, indent)
+
+    return _emit_unknown(value, indent)
+
+
+# Precomputed indentation strings for the usual nesting depths
+_INDENTS = tuple("    " * i for i in range(17))
+
+
+def _indent(level: int) -> str:
+    """Return the indentation for a nesting level."""
+    if 0 <= level < len(_INDENTS):
+        return _INDENTS[level]
+    return "    " * level
+
+
+def _emit_set(value: dict, indent: int) -> str:
+    elements = value.get("elements", _NO_ITEMS)
+    if not elements:
+        return "HashSet::new()"
+    els = ", ".join(tla_to_rust_value(e, indent) for e in elements)
+    return f"HashSet::from([{els}])"
 
+
+def _emit_sequence(value: dict, indent: int) -> str:
+    elements = value.get("elements", _NO_ITEMS)
+    if not elements:
+        return "vec![]"
+    els = ", ".join(tla_to_rust_value(e, indent) for e in elements)
+    return f"vec![{els}]"
+
+
+def _emit_record(value: dict, indent: int) -> str:
+    fields = value.get("fields", _NO_FIELDS)
+    if not fields:
+        return "/* empty record */"
+    # This is context-dependent - generate a struct literal comment
+    ind = _indent(indent)
+    field_ind = _indent(indent + 1)
+    field_strs = []
+    for k, v in fields.items():
+        field_strs.append(f"{k}: {tla_to_rust_value(v, indent + 1)}")
+    return "{\n" + field_ind + (",\n" + field_ind).join(field_strs) + "\n" + ind + "}"
+
+
+def _emit_function(value: dict, indent: int) -> str:
+    mapping = value.get("mapping", _NO_FIELDS)
+    if not mapping:
+        return "HashMap::new()"
+    entries = []
+    for k, v in mapping.items():
+        entries.append(f"({tla_to_rust_value(k)}, {tla_to_rust_value(v)})")
+    return f"HashMap::from([{', '.join(entries)}])"
+
+
+def _emit_unknown(value: Any, indent: int) -> str:
     return f"/* unknown: {value} */"
 
 
+# Dispatch on the exact type of a value; bool has its own entry because
+# type(True) is bool, not int
+_SCALAR_HANDLERS = {
+    type(None): lambda value, indent: "None",
+    bool: lambda value, indent: "true" if value else "false",
+    int: lambda value, indent: str(value),
+    str: lambda value, indent: f'"{value}"',
+}
+
+# Dispatch on the "type" tag of structured values
+_DICT_HANDLERS = {
+    "set": _emit_set,
+    "sequence": _emit_sequence,
+    "record": _emit_record,
+    "function": _emit_function,
+}
+
+
+# BookingMethods actions that add a lot
+_ADD_ACTIONS = frozenset({"AddLot", "Add"})
+
+# BookingMethods reduce actions and the BookingMethod variant they use
+_REDUCE_METHODS = {
+    "ReduceFIFO": "FIFO",
+    "ReduceLIFO": "LIFO",
+    "ReduceHIFO": "HIFO",
+    "ReduceSTRICT": "STRICT",
+    "ReduceAVERAGE": "AVERAGE",
+}
+
+
 def generate_booking_test(trace: dict, test_name: str) -> str:
     """Generate a Rust test for a BookingMethods trace."""
     states = trace.get("states", [])
     invariant = trace.get("invariant_violated", "Unknown")
 
-    lines = [
-        f"/// Generated from TLA+ counterexample",
-        f"/// Invariant violated: {invariant}",
-        f"#[test]",
-        f"fn {test_name}() {{",
-        f"    let mut inventory = setup_inventory();",
-        f"",
-    ]
+    buf = io.StringIO()
+    buf.write(
+        "/// Generated from TLA+ counterexample\n"
+        f"/// Invariant violated: {invariant}\n"
+        "#[test]\n"
+        f"fn {test_name}() {{\n"
+        "    let mut inventory = setup_inventory();\n"
+        "\n"
+    )
 
     for state in states:
         action = state.get("action", "Unknown")
-        vars = state.get("variables", {})
 
         if action == "Init":
-            lines.append(f"    // Initial state")
+            buf.write("    // Initial state\n")
             continue
 
-        if action in ("AddLot", "Add"):
+        if action in _ADD_ACTIONS:
             # Extract lot info from variables
+            vars = state.get("variables", _NO_FIELDS)
             currency_val = vars.get("currency", "USD")
             currency = (
                 list(currency_val.get("elements", ["USD"]))[0]
@@ -187,22 +281,28 @@ def generate_booking_test(trace: dict, test_name: str) -> str:
                 else "USD"
             )
 
-            lines.append(f"    // Action: {action} (currency: {currency})")
-            lines.append(f"    // TODO: Extract lot details from trace")
-            lines.append(f"    // inventory.add_position(position);")
+            buf.write(
+                f"    // Action: {action} (currency: {currency})\n"
+                "    // TODO: Extract lot details from trace\n"
+                "    // inventory.add_position(position);\n"
+            )
 
-        elif action in ("ReduceFIFO", "ReduceLIFO", "ReduceHIFO", "ReduceSTRICT", "ReduceAVERAGE"):
-            method = action.replace("Reduce", "").upper()
-            lines.append(f"    // Action: {action}")
-            lines.append(f"    // TODO: Extract reduction details from trace")
-            lines.append(f"    // inventory.reduce(BookingMethod::{method}, units, &spec);")
+        elif action in _REDUCE_METHODS:
+            method = _REDUCE_METHODS[action]
+            buf.write(
+                f"    // Action: {action}\n"
+                "    // TODO: Extract reduction details from trace\n"
+                f"    // inventory.reduce(BookingMethod::{method}, units, &spec);\n"
+            )
 
-    lines.append(f"")
-    lines.append(f"    // Verify invariant would have been violated")
-    lines.append(f"    // assert!(...);")
-    lines.append(f"}}")
+    buf.write(
+        "\n"
+        "    // Verify invariant would have been violated\n"
+        "    // assert!(...);\n"
+        "}"
+    )
 
-    return "\n".join(lines)
+    return buf.getvalue()
 
 
 def generate_validation_test(trace: dict, test_name: str) -> str:
@@ -210,25 +310,26 @@ def generate_validation_test(trace: dict, test_name: str) -> str:
     states = trace.get("states", [])
     invariant = trace.get("invariant_violated", "Unknown")
 
-    lines = [
-        f"/// Generated from TLA+ counterexample",
-        f"/// Invariant violated: {invariant}",
-        f"#[test]",
-        f"fn {test_name}() {{",
-        f"    let mut validator = Validator::new();",
-        f"",
-    ]
+    buf = io.StringIO()
+    buf.write(
+        "/// Generated from TLA+ counterexample\n"
+        f"/// Invariant violated: {invariant}\n"
+        "#[test]\n"
+        f"fn {test_name}() {{\n"
+        "    let mut validator = Validator::new();\n"
+        "\n"
+    )
 
     for state in states:
         action = state.get("action", "Unknown")
-        vars = state.get("variables", {})
 
         if action == "Init":
-            lines.append(f"    // Initial state")
+            buf.write("    // Initial state\n")
             continue
 
         if "Error" in action or "Add" in action:
-            lines.append(f"    // Action: {action}")
+            buf.write(f"    // Action: {action}\n")
+            vars = state.get("variables", _NO_FIELDS)
             if "errors" in vars:
                 errors = vars["errors"]
                 if isinstance(errors, dict) and errors.get("type") == "set":
@@ -236,24 +337,32 @@ def generate_validation_test(trace: dict, test_name: str) -> str:
                         if isinstance(err, dict) and err.get("type") == "record":
                             fields = err.get("fields", {})
                             code = fields.get("code", "E1001")
-                            lines.append(f"    // Error: {code}")
-
-    lines.append(f"")
-    lines.append(f"    // Verify expected errors")
-    lines.append(f"    // let errors = validator.validate(&ledger);")
-    lines.append(f"    // assert!(...);")
-    lines.append(f"}}")
+                            buf.write(f"    // Error: {code}\n")
+
+    buf.write(
+        "\n"
+        "    // Verify expected errors\n"
+        "    // let errors = validator.validate(&ledger);\n"
+        "    // assert!(...);\n"
+        "}"
+    )
 
-    return "\n".join(lines)
+    return buf.getvalue()
 
 
-def generate_test_from_trace(trace: dict, test_num: int = 1) -> str:
-    """Generate a Rust test from a TLA+ trace."""
+def _test_name(trace: dict, test_num: int) -> str:
+    """Return the Rust test function name for a trace."""
     spec_name = trace.get("spec_name", "Unknown")
     invariant = trace.get("invariant_violated", "unknown")
     test_name = f"tla_trace_{spec_name.lower()}_{invariant.lower()}_{test_num}"
     # Sanitize test name
-    test_name = "".join(c if c.isalnum() or c == "_" else "_" for c in test_name)
+    return _SANITIZE_RE.sub("_", test_name)
+
+
+def generate_test_from_trace(trace: dict, test_num: int = 1) -> str:
+    """Generate a Rust test from a TLA+ trace."""
+    spec_name = trace.get("spec_name", "Unknown")
+    test_name = _test_name(trace, test_num)
 
     if spec_name == "BookingMethods":
         return generate_booking_test(trace, test_name)
@@ -270,85 +379,206 @@ def generate_generic_test(trace: dict, test_name: str) -> str:
     invariant = trace.get("invariant_violated", "Unknown")
     property_violated = trace.get("property_violated")
 
-    lines = [
-        f"/// Generated from TLA+ counterexample",
-        f"/// Spec: {trace.get('spec_name', 'Unknown')}",
-    ]
+    buf = io.StringIO()
+    buf.write(
+        "/// Generated from TLA+ counterexample\n"
+        f"/// Spec: {trace.get('spec_name', 'Unknown')}\n"
+    )
 
     if invariant:
-        lines.append(f"/// Invariant violated: {invariant}")
+        buf.write(f"/// Invariant violated: {invariant}\n")
     if property_violated:
-        lines.append(f"/// Property violated: {property_violated}")
+        buf.write(f"/// Property violated: {property_violated}\n")
 
-    lines.extend([
-        f"#[test]",
-        f"fn {test_name}() {{",
-    ])
+    buf.write(
+        "#[test]\n"
+        f"fn {test_name}() {{\n"
+    )
 
     for i, state in enumerate(states):
         action = state.get("action", "Unknown")
         state_num = state.get("state_num", i)
 
-        lines.append(f"")
-        lines.append(f"    // State {state_num}: {action}")
+        buf.write(f"\n    // State {state_num}: {action}\n")
 
-        for var_name, var_value in state.get("variables", {}).items():
+        for var_name, var_value in state.get("variables", _NO_FIELDS).items():
             rust_value = tla_to_rust_value(var_value, 1)
-            lines.append(f"    // {var_name} = {rust_value}")
+            buf.write(f"    // {var_name} = {rust_value}\n")
+
+    buf.write(
+        "\n"
+        "    // TODO: Implement test based on trace\n"
+        "    todo!(\"Implement test from TLA+ trace\");\n"
+        "}"
+    )
+
+    return buf.getvalue()
+
+
+# Below this many traces, process pool startup costs more than it saves
+PARALLEL_MIN_TRACES = 8
+
 
-    lines.extend([
-        f"",
-        f"    // TODO: Implement test based on trace",
-        f"    todo!(\"Implement test from TLA+ trace\");",
-        f"}}",
-    ])
+def _render_one(numbered_trace: tuple[int, dict]) -> str:
+    """Render one (test number, trace) pair (process pool worker)."""
+    test_num, trace = numbered_trace
+    return generate_test_from_trace(trace, test_num)
 
-    return "\n".join(lines)
 
+def _canonical_json(value: Any) -> bytes:
+    """Serialize a parsed JSON value with sorted keys, for hashing."""
+    if orjson is not None:
+        return orjson.dumps(value, option=orjson.OPT_SORT_KEYS)
+    return json.dumps(value, sort_keys=True, separators=(",", ":")).encode()
 
-def generate_test_module(traces: list[dict], module_name: str = "tla_traces") -> str:
-    """Generate a complete Rust test module from multiple traces."""
-    # Collect all spec names
-    spec_names = set(t.get("spec_name", "Unknown") for t in traces)
 
-    # Build imports
-    imports = set()
-    setups = []
+def _trace_key(trace: dict) -> bytes:
+    """Return a digest of a trace's contents, equal for duplicate traces.
+
+    The parsed values are hashed, not the file bytes, and the states one at
+    a time, so a streamed trace is never held in memory whole and gets the
+    same key as when it is loaded eagerly.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(_canonical_json({k: v for k, v in trace.items() if k != "states"}))
+    for state in trace.get("states", _NO_ITEMS):
+        digest.update(_canonical_json(state))
+    return digest.digest()
+
+
+def _render_unique(numbered: list[tuple[int, dict]]) -> Iterator[str]:
+    """Yield the rendered test for each (test number, trace) pair, in order.
+
+    Traces are independent, so large bundles are rendered in parallel
+    processes.
+    """
+    if len(numbered) < PARALLEL_MIN_TRACES:
+        yield from map(_render_one, numbered)
+    else:
+        with ProcessPoolExecutor() as ex:
+            yield from ex.map(_render_one, numbered, chunksize=16)
+
+
+def _render_tests(traces: list[dict]) -> Iterator[str]:
+    """Yield the rendered test for each trace, in order.
+
+    Model checking often produces the same counterexample more than once;
+    each distinct trace is rendered once and its duplicates reuse the text
+    with only the test number in the function name changed. A rendered test
+    is only kept while duplicates of it are still to come.
+    """
+    keys = [_trace_key(trace) for trace in traces]
+    first: dict[bytes, int] = {}
+    for test_num, key in enumerate(keys, 1):
+        first.setdefault(key, test_num)
+    remaining = Counter(keys)
+
+    rendered = _render_unique([(n, traces[n - 1]) for n in first.values()])
+    cached: dict[bytes, str] = {}
+    for test_num, (trace, key) in enumerate(zip(traces, keys), 1):
+        remaining[key] -= 1
+        first_num = first[key]
+        if first_num == test_num:
+            test_code = next(rendered)
+            if remaining[key]:
+                cached[key] = test_code
+            yield test_code
+        else:
+            test_code = cached[key] if remaining[key] else cached.pop(key)
+            old_fn = f"fn {_test_name(trace, first_num)}()"
+            new_fn = f"fn {_test_name(trace, test_num)}()"
+            yield test_code.replace(old_fn, new_fn, 1)
+
+
+def generate_test_module(
+    traces: list[dict], module_name: str = "tla_traces"
+) -> Iterator[str]:
+    """Yield a complete Rust test module for multiple traces as text chunks."""
+    # Collect all spec names, in order of first appearance
+    spec_names = dict.fromkeys(t.get("spec_name", "Unknown") for t in traces)
+
+    # Build imports and helpers; dicts keep them ordered and unique
+    imports: dict[str, None] = {}
+    helpers: dict[str, str] = {}
 
     for spec_name in spec_names:
         if spec_name in SPEC_TEMPLATES:
-            imports.add(SPEC_TEMPLATES[spec_name]["imports"])
-            setups.append(SPEC_TEMPLATES[spec_name]["setup"])
-
-    lines = [
-        f"//! Auto-generated tests from TLA+ counterexample traces",
-        f"//! ",
-        f"//! Generated by: scripts/trace_to_rust_test.py",
-        f"//! ",
-        f"//! DO NOT EDIT MANUALLY",
-        f"",
-        f"#![allow(dead_code)]",
-        f"#![allow(unused_imports)]",
-        f"#![allow(unused_variables)]",
-        f"",
-    ]
-
-    for imp in imports:
-        lines.append(imp.strip())
-
-    lines.append("")
-
-    for setup in setups:
-        lines.append(setup.strip())
-        lines.append("")
+            imports.update(dict.fromkeys(_SPEC_IMPORTS[spec_name]))
+            for name, code in _SPEC_HELPERS[spec_name].items():
+                helpers.setdefault(name, code)
+
+    yield (
+        "//! Auto-generated tests from TLA+ counterexample traces\n"
+        "//! \n"
+        "//! Generated by: scripts/trace_to_rust_test.py\n"
+        "//! \n"
+        "//! DO NOT EDIT MANUALLY\n"
+        "\n"
+        "#![allow(dead_code)]\n"
+        "#![allow(unused_imports)]\n"
+        "#![allow(unused_variables)]\n"
+        "\n"
+        + "".join(imp + "\n" for imp in imports)
+        + "\n"
+    )
+
+    for helper in helpers.values():
+        yield helper + "\n\n"
 
     # Generate tests
-    for i, trace in enumerate(traces, 1):
-        test_code = generate_test_from_trace(trace, i)
-        lines.append("")
-        lines.append(test_code)
+    for test_code in _render_tests(traces):
+        yield "\n" + test_code + "\n"
+
+
+# ijson events carrying a scalar value
+_SCALAR_EVENTS = frozenset({"null", "boolean", "integer", "double", "number", "string"})
+
+# Top-level fields tla_trace_to_json.py writes alongside "states"
+_HEADER_FIELDS = frozenset({"spec_name", "invariant_violated", "property_violated"})
 
-    return "\n".join(lines)
+
+class StreamedStates:
+    """The "states" array of a trace file, parsed lazily with ijson.
+
+    Each iteration re-reads the file and yields one state at a time, so a
+    trace's states are never all in memory at once.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+
+    def __iter__(self) -> Iterator[dict]:
+        with open(self.path, "rb") as f:
+            yield from ijson.items(f, "states.item", use_float=True)
+
+
+def load_trace(path: Path) -> dict:
+    """Load a JSON trace file.
+
+    With ijson installed, only the top-level scalar fields (spec name,
+    violated invariant/property) are read up front; the states are streamed
+    from the file when a test is generated. The scalar pass stops at the
+    "states" array once all header fields have been seen, which is where
+    tla_trace_to_json.py writes them. Without ijson, the whole file is
+    loaded with orjson if it is installed, or json otherwise.
+    """
+    if ijson is None:
+        with open(path, "rb") as f:
+            if orjson is not None:
+                return orjson.loads(f.read())
+            return json.load(f)
+
+    trace: dict[str, Any] = {}
+    with open(path, "rb") as f:
+        for prefix, event, value in ijson.parse(f, use_float=True):
+            if prefix == "states":
+                if _HEADER_FIELDS <= trace.keys():
+                    break
+                continue
+            if event in _SCALAR_EVENTS and prefix and "." not in prefix:
+                trace[prefix] = value
+    trace["states"] = StreamedStates(path)
+    return trace
 
 
 def main():
@@ -375,20 +605,23 @@ def main():
     args = parser.parse_args()
 
     # Load all traces
-    traces = []
-    for trace_path in args.traces:
-        with open(trace_path) as f:
-            trace = json.load(f)
-            traces.append(trace)
+    traces = [load_trace(trace_path) for trace_path in args.traces]
 
     # Generate module
-    rust_code = generate_test_module(traces, args.module)
-
     if args.output:
-        args.output.write_text(rust_code)
+        # Stream into a sibling temporary file and move it into place once
+        # every test has rendered, so a failed run leaves the target as it was
+        tmp_path = args.output.with_name(f".{args.output.name}.tmp")
+        try:
+            with open(tmp_path, "w", buffering=1 << 20) as out:
+                out.writelines(generate_test_module(traces, args.module))
+            os.replace(tmp_path, args.output)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
         print(f"Generated {args.output}", file=sys.stderr)
     else:
-        print(rust_code)
+        sys.stdout.writelines(generate_test_module(traces, args.module))
 
 
 if __name__ == "__main__":
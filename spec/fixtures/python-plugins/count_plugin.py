@@ -1,10 +1,11 @@
 # Plugin that counts entries by type
+from collections import Counter
+
+
 def plugin(entries, options_map, config=None):
     """Count entries by type and print summary."""
-    counts = {}
-    for entry in entries:
-        entry_type = type(entry).__name__
-        counts[entry_type] = counts.get(entry_type, 0) + 1
+    by_type = Counter(map(type, entries))
+    counts = {entry_type.__name__: n for entry_type, n in by_type.items()}
 
     print(f"Entry counts: {counts}")
     return entries, []
@@ -1,13 +1,12 @@
 # Plugin that generates validation errors for testing
+from beancount.core.data import Transaction
+
+
 def plugin(entries, options_map, config=None):
     """Generate errors for transactions without payees."""
-    errors = []
-    for entry in entries:
-        if type(entry).__name__ == 'Transaction':
-            if not entry.payee:
-                errors.append(ValidationError(
-                    entry.meta,
-                    f"Transaction on {entry.date} has no payee",
-                    entry
-                ))
+    errors = [
+        ValidationError(entry.meta, f"Transaction on {entry.date} has no payee", entry)
+        for entry in entries
+        if type(entry) is Transaction and not entry.payee
+    ]
     return entries, errors
@@ -1,25 +1,48 @@
 # Plugin that adds tags to transactions based on account patterns
+from operator import attrgetter
+
+from beancount.core.data import Transaction
+
+# Account prefix -> tag added to transactions with a posting under it
+ACCOUNT_TAGS = {
+    'Expenses:Food': 'food',
+}
+
+# All prefixes at once, so str.startswith can reject a posting in one call
+_PREFIXES = tuple(ACCOUNT_TAGS)
+
+# Every tag the plugin can add
+_ALL_TAGS = frozenset(ACCOUNT_TAGS.values())
+
+# Fetches both transaction fields the plugin reads in a single call
+_txn_fields = attrgetter('postings', 'tags')
+
+
+def _maybe_tag(entry):
+    """Return entry with the tags of every matching account prefix added."""
+    if type(entry) is not Transaction:
+        return entry
+    postings, tags = _txn_fields(entry)
+    if _ALL_TAGS <= tags:
+        return entry
+    new_tags = None
+    for posting in postings:
+        account = posting.account
+        if account.startswith(_PREFIXES):
+            if new_tags is None:
+                new_tags = set()
+            new_tags.update(tag for prefix, tag in ACCOUNT_TAGS.items()
+                            if account.startswith(prefix))
+            if len(new_tags) == len(_ALL_TAGS):
+                # Every tag found; the remaining postings can't add any
+                break
+    if new_tags and not new_tags <= tags:
+        # Create new transaction with added tags; tags is a frozenset,
+        # so the union is one too
+        return entry._replace(tags=tags | new_tags)
+    return entry
+
+
 def plugin(entries, options_map, config=None):
-    """Add #food tag to transactions with Expenses:Food postings."""
-    new_entries = []
-    for entry in entries:
-        if type(entry).__name__ == 'Transaction':
-            has_food = any(
-                p.account.startswith('Expenses:Food')
-                for p in entry.postings
-            )
-            if has_food and 'food' not in entry.tags:
-                # Create new transaction with added tag
-                new_tags = frozenset(entry.tags | {'food'})
-                entry = Transaction(
-                    meta=entry.meta,
-                    date=entry.date,
-                    flag=entry.flag,
-                    payee=entry.payee,
-                    narration=entry.narration,
-                    tags=new_tags,
-                    links=entry.links,
-                    postings=entry.postings
-                )
-        new_entries.append(entry)
-    return new_entries, []
+    """Add tags to transactions with postings under the ACCOUNT_TAGS prefixes."""
+    return [_maybe_tag(entry) for entry in entries], []